@@ -0,0 +1,466 @@
+# benchmarks for the BlitzBoard storage layer, not collected by pytest
+# run from the repository root:
+#   python -m Api.Tests.benchmarks rank 1000 10000 100000 1000000
+#   python -m Api.Tests.benchmarks scorer 10000
+#   python -m Api.Tests.benchmarks throughput 1 2 4
+#   python -m Api.Tests.benchmarks export 10000 100000
+#   python -m Api.Tests.benchmarks import 10000 100000
+#   python -m Api.Tests.benchmarks json 1000 10000
+#   python -m Api.Tests.benchmarks load --server gunicorn --workload mixed --players 1000 --scores 10000
+
+import argparse
+import contextlib
+import datetime
+import http.client
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+import uuid
+
+import peewee
+
+from Api import client as api
+
+MODELS = [api.Config, api.Game, api.Player, api.PlayerGame, api.Score, api.PeriodScore]
+
+
+def timed(fn, repeat):
+    # mean wall time of fn in microseconds
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def seed_scores(game, size, chunk_size=10000):
+    # the leaderboard holds one score per player
+    for start in range(0, size, chunk_size):
+        players = [uuid.uuid4() for _ in range(start, min(size, start + chunk_size))]
+        api.Player.insert_many([{"id": player, "name": "bench"} for player in players]).execute()
+        api.Score.insert_many([
+            {"player": player, "game": game, "json_score": {"points": i},
+             "hidden_score": api.pack_sort_key([random.randrange(size)])}
+            for i, player in enumerate(players)
+        ]).execute()
+
+
+def bench_rank(sizes, samples=200):
+    # rank latency against table size, with the leaderboard index, a full scan and the in-memory rank index
+    print("%10s %18s %18s %18s" % ("rows", "indexed rank us", "full scan rank us", "rank index us"))
+    for size in sizes:
+        db = peewee.SqliteDatabase(':memory:')
+        with db.bind_ctx(MODELS):
+            db.create_tables(MODELS)
+            config = api.Config.create(template={})
+            game = api.Game.create(name="bench", config=config)
+            seed_scores(game, size)
+            probes = list(api.Score.select().order_by(peewee.fn.Random()).limit(samples))
+
+            def rank_all():
+                for score in probes:
+                    api.score_rank(game, score.hidden_score, score.id, False)
+
+            indexed = timed(rank_all, 1) / len(probes)
+            db.execute_sql('DROP INDEX score_leaderboard')
+            full_scan = timed(rank_all, 1) / len(probes)
+
+            api.app.config["RANK_INDEX"] = True
+            api.RANK_INDEXES.rank(game, api.pack_sort_key([0]), 0, False)
+            in_memory = timed(rank_all, 1) / len(probes)
+            api.app.config["RANK_INDEX"] = False
+            api.RANK_INDEXES.clear()
+        db.close()
+        print("%10d %18.1f %18.1f %18.1f" % (size, indexed, full_scan, in_memory))
+
+
+# offset desc terms were subtracted from before sort keys could be negative
+LEGACY_MAX_INT = 2 ** 31 - 1
+
+
+def legacy_hidden_score(score, config):
+    # per submission template walk used before scorers were compiled, kept as the baseline
+    score_config = config.template
+    hidden_score = 0
+    for key in score:
+        if config.priority_mode:
+            if score_config[key]["priority"] == 1:
+                if score_config[key]["desc"]:
+                    hidden_score += LEGACY_MAX_INT - int(score[key])
+                else:
+                    hidden_score += int(score[key])
+        else:
+            if score_config[key]["weight"] == 0:
+                continue
+            if score_config[key]["type"] == "int":
+                if score_config[key]["desc"]:
+                    hidden_score += LEGACY_MAX_INT - int(score[key]) * float(score_config[key]["weight"])
+                else:
+                    hidden_score += int(score[key]) * float(score_config[key]["weight"])
+            elif score_config[key]["type"] == "float":
+                if score_config[key]["desc"]:
+                    hidden_score += LEGACY_MAX_INT - float(score[key]) * float(score_config[key]["weight"])
+                else:
+                    hidden_score += float(score[key]) * float(score_config[key]["weight"])
+    return api.pack_sort_key([int(hidden_score)])
+
+
+def bench_scorer(sizes):
+    # hidden score cpu time per submission, template walk against the compiled scorer
+    template = {"key_%d" % i: {"weight": 0.1, "type": "float" if i % 2 else "int", "desc": i % 3 == 0}
+                for i in range(10)}
+    config = api.Config(id=0, template=template, priority_mode=False)
+    print("%10s %18s %18s" % ("scores", "template walk us", "compiled us"))
+    for size in sizes:
+        scores = [{key: random.randrange(1000) for key in template} for _ in range(size)]
+        scorer = api.CompiledScorer(config)
+        # the float walk rounds then truncates to integers, it orders no pair the other way round by more than one
+        keyed = [api.unpack_sort_key(legacy_hidden_score(score, config))[0] for score in sorted(scores, key=scorer)]
+        assert all(a <= b + 1 for a, b in zip(keyed, keyed[1:]))
+        legacy = timed(lambda: [legacy_hidden_score(score, config) for score in scores], 1) / size
+        compiled = timed(lambda: [scorer(score) for score in scores], 1) / size
+        print("%10d %18.2f %18.2f" % (size, legacy, compiled))
+
+
+def peak_memory(fn):
+    # peak python heap allocated while fn runs, in KiB
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+
+
+def bench_export(sizes):
+    # peak memory of a full leaderboard export, streamed ndjson against the materialized page of Scores.get
+    print("%10s %18s %18s" % ("rows", "streamed KiB", "materialized KiB"))
+    for size in sizes:
+        db = peewee.SqliteDatabase(':memory:')
+        with db.bind_ctx(MODELS):
+            db.create_tables(MODELS)
+            config = api.Config.create(template={"points": {"weight": 1.0, "type": "int", "desc": False}})
+            game = api.Game.select(api.Game, api.Config).join(api.Config) \
+                .where(api.Game.id == api.Game.create(name="bench", config=config).id).get()
+            seed_scores(game, size)
+
+            def streamed():
+                for _ in api.buffered(api.export_ndjson(game, api.leaderboard_rows(game)), api.EXPORT_BUFFER_SIZE):
+                    pass
+
+            def materialized():
+                scores = api.leaderboard_page(game, 0, size)
+                json.dumps([{"name": score.player.name, "score": score.json_score, "rank": rank}
+                            for score, rank in zip(scores, api.rank_rows(game, scores, False))])
+
+            print("%10d %18.0f %18.0f" % (size, peak_memory(streamed), peak_memory(materialized)))
+        db.close()
+
+
+def bench_import(sizes):
+    # bulk import rows per second into a file database, maintaining the leaderboard index against deferring it
+    print("%10s %18s %18s" % ("rows", "kept index rows/s", "deferred rows/s"))
+    for size in sizes:
+        lines = [json.dumps({"name": "bench", "score": {"points": random.randrange(size)}}) for _ in range(size)]
+        rates = []
+        for defer in (False, True):
+            with tempfile.TemporaryDirectory() as workdir:
+                api.Database.configure("sqlite:///" + os.path.join(workdir, "bench.db"))
+                api.Database.create_db()
+                config = api.Config.create(template=CONFIG["template"])
+                game = api.Game.select(api.Game, api.Config).join(api.Config) \
+                    .where(api.Game.id == api.Game.create(name="bench", config=config).id).get()
+                start = time.perf_counter()
+                with api.deferred_leaderboard_index() if defer else contextlib.nullcontext():
+                    api.ScoreImport(game).load(api.parse_ndjson(lines, game))
+                rates.append(size / (time.perf_counter() - start))
+                api.Database.close()
+        print("%10d %18.0f %18.0f" % (size, rates[0], rates[1]))
+
+
+def bench_json(sizes):
+    # ms to turn a page of stored scores into the response body, per 10k rows: decoded and encoded by the stdlib
+    # like the default flask provider, by the orjson provider, and spliced in as stored text (RAW_JSON_SCORES)
+    print("%10s %18s %18s %18s" % ("rows", "stdlib ms/10k", "orjson ms/10k", "raw ms/10k"))
+    default, fast = api.DefaultJSONProvider(api.app), api.FastJSONProvider(api.app)
+    for size in sizes:
+        # scores of ten keys like the scorer benchmark template
+        rows = [("player %d" % i, json.dumps({"key_%d" % k: random.random() * 1000 if k % 2 else random.randrange(1000)
+                                              for k in range(10)}), i + 1) for i in range(size)]
+
+        def stdlib():
+            default.dumps([{"name": name, "score": json.loads(text), "rank": rank} for name, text, rank in rows])
+
+        def orjson():
+            fast.dumps([{"name": name, "score": api.json_loads(text), "rank": rank} for name, text, rank in rows])
+
+        def raw():
+            "[" + ", ".join(api.with_raw_score({"name": name, "rank": rank}, text) for name, text, rank in rows) + "]"
+
+        per_10k = [timed(fn, 5) / 1000 * 10000 / size for fn in (stdlib, orjson, raw)]
+        print("%10d %18.2f %18.2f %18.2f" % ((size,) + tuple(per_10k)))
+
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG = {"template": {"points": {"weight": 1.0, "type": "int", "desc": False}}}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextlib.contextmanager
+def gunicorn_server(workers, threads=4):
+    # gunicorn serving the api from a fresh database in a temporary directory, yields its port
+    port = free_port()
+    with tempfile.TemporaryDirectory() as workdir:
+        server = subprocess.Popen([
+            sys.executable, "-m", "gunicorn", "client:app", "--pythonpath", API_DIR, "--preload",
+            "-w", str(workers), "--threads", str(threads), "-b", "127.0.0.1:%d" % port,
+        ], cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            for _ in range(100):
+                try:
+                    socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            yield port
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def request(connection, method, url, body=None, form=None):
+    headers = {}
+    if body is not None:
+        body, headers = json.dumps(body), {"Content-Type": "application/json"}
+    elif form is not None:
+        body = urllib.parse.urlencode(form)
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+    connection.request(method, url, body=body, headers=headers)
+    response = connection.getresponse()
+    return response.status, response.read()
+
+
+def http_sender(port):
+    # send(method, url, body=None, form=None) -> (status, body) over its own keep-alive connection
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    return lambda method, url, body=None, form=None: request(connection, method, url, body, form)
+
+
+def test_client_sender():
+    # send() through the flask test client, the app runs in this process
+    client = api.app.test_client()
+
+    def send(method, url, body=None, form=None):
+        response = client.open(url, method=method, json=body, data=form)
+        return response.status_code, response.get_data()
+    return send
+
+
+def seed_http(send, players, scores=None, games=("bench",)):
+    # the given games and players, then `scores` submissions per game (one per player by default),
+    # the first ones go to every player in turn and the others to random players, returns the player ids
+    scores = players if scores is None else scores
+    for name in games:
+        send("POST", "/games", form={"name": name, "config": json.dumps(CONFIG)})
+    player_ids = [json.loads(send("POST", "/players", body={"name": "player %d" % i})[1]) for i in range(players)]
+    for name in games:
+        for start in range(0, scores, api.MAX_BATCH_SIZE):
+            send("POST", "/games/%s/scores" % name, body={"scores": [
+                {"player_id": player_ids[i] if i < players else random.choice(player_ids),
+                 "score": {"points": random.randrange(10000)}}
+                for i in range(start, min(scores, start + api.MAX_BATCH_SIZE))]})
+    return player_ids
+
+
+def bench_throughput(worker_counts, duration=5.0, clients=16):
+    # requests per second of a mixed workload against gunicorn, 80% top 50 pages, 10% ranks, 10% submissions
+    print("%10s %18s" % ("workers", "requests/s"))
+    for workers in worker_counts:
+        with gunicorn_server(workers) as port:
+            player_ids = seed_http(http_sender(port), 200)
+            counts = [0] * clients
+            deadline = time.perf_counter() + duration
+
+            def client(n):
+                connection = http.client.HTTPConnection("127.0.0.1", port)
+                while time.perf_counter() < deadline:
+                    roll = random.random()
+                    if roll < 0.8:
+                        request(connection, "GET", "/games/bench/scores?top=50")
+                    elif roll < 0.9:
+                        request(connection, "GET", "/games/bench/scores/" + random.choice(player_ids))
+                    else:
+                        request(connection, "POST", "/games/bench/scores/" + random.choice(player_ids),
+                                body={"score": json.dumps({"points": random.randrange(10000)})})
+                    counts[n] += 1
+
+            pool = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+            for thread in pool:
+                thread.start()
+            for thread in pool:
+                thread.join()
+        print("%10d %18.1f" % (workers, sum(counts) / duration))
+
+
+@contextlib.contextmanager
+def in_process_server():
+    # the app on a fresh file database in a temporary directory, yields a sender factory
+    with tempfile.TemporaryDirectory() as workdir:
+        api.Database.configure("sqlite:///" + os.path.join(workdir, "bench.db"))
+        api.Database.create_db()
+        try:
+            yield test_client_sender
+        finally:
+            api.Database.close()
+
+
+@contextlib.contextmanager
+def gunicorn_senders(workers, threads):
+    with gunicorn_server(workers, threads) as port:
+        yield lambda: http_sender(port)
+
+
+# leaderboard operations, each sends one request for a game and a player holding a score in it
+OPERATIONS = {
+    "submit": lambda send, game, player_id: send("POST", "/games/%s/scores/%s" % (game, player_id),
+                                                 body={"score": json.dumps({"points": random.randrange(10000)})}),
+    "rank": lambda send, game, player_id: send("GET", "/games/%s/scores/%s" % (game, player_id)),
+    "top": lambda send, game, player_id: send("GET", "/games/%s/scores?top=50" % game),
+    "list": lambda send, game, player_id: send("GET", "/games/%s/export" % game),
+}
+
+# share of each operation in a workload
+WORKLOADS = {
+    "read": {"rank": 0.3, "top": 0.6, "list": 0.1},
+    "mixed": {"submit": 0.2, "rank": 0.2, "top": 0.5, "list": 0.1},
+    "write": {"submit": 0.9, "rank": 0.1},
+}
+
+
+def percentile(latencies, q):
+    # nearest rank percentile of sorted latencies
+    return latencies[max(0, math.ceil(q / 100 * len(latencies)) - 1)] if latencies else None
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    summary = {"requests": len(latencies), "errors": errors, "throughput_rps": round(len(latencies) / elapsed, 1)}
+    for q in (50, 95, 99):
+        value = percentile(latencies, q)
+        summary["p%d_ms" % q] = value if value is None else round(value * 1000, 3)
+    return summary
+
+
+def drive(make_sender, games, player_ids, mix, clients, duration):
+    # clients threads send operations picked by weight until the deadline,
+    # returns the latencies in seconds and the error count (4xx and 5xx) of each operation
+    names, weights = list(mix), list(mix.values())
+    results = [({name: [] for name in names}, dict.fromkeys(names, 0)) for _ in range(clients)]
+    deadline = time.perf_counter() + duration
+
+    def client(latencies, errors):
+        send = make_sender()
+        while time.perf_counter() < deadline:
+            name = random.choices(names, weights)[0]
+            start = time.perf_counter()
+            status, _ = OPERATIONS[name](send, random.choice(games), random.choice(player_ids))
+            latencies[name].append(time.perf_counter() - start)
+            errors[name] += status >= 400
+
+    pool = [threading.Thread(target=client, args=result) for result in results]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return {name: ([latency for latencies, _ in results for latency in latencies[name]],
+                   sum(errors[name] for _, errors in results)) for name in names}
+
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=API_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_load(argv):
+    # latency percentiles and throughput of a leaderboard workload, in process or against gunicorn, as json
+    parser = argparse.ArgumentParser(prog="python -m Api.Tests.benchmarks load")
+    parser.add_argument("--server", choices=("inprocess", "gunicorn"), default="inprocess")
+    parser.add_argument("--workload", choices=tuple(WORKLOADS), default="mixed")
+    parser.add_argument("--players", type=int, default=1000, help="players created before the run")
+    parser.add_argument("--scores", type=int, default=None, help="scores submitted per game, one per player by default")
+    parser.add_argument("--games", type=int, default=1)
+    parser.add_argument("--clients", type=int, default=16, help="concurrent client threads")
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=1.0, help="seconds run before measuring")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn worker processes")
+    parser.add_argument("--threads", type=int, default=4, help="gunicorn threads per worker")
+    parser.add_argument("--output", help="also write the report to this file")
+    args = parser.parse_args(argv)
+
+    games = ["bench%d" % i for i in range(args.games)]
+    server = in_process_server() if args.server == "inprocess" else gunicorn_senders(args.workers, args.threads)
+    with server as make_sender:
+        player_ids = seed_http(make_sender(), args.players, args.scores, games)
+        # every player holds a score once seeding gave each of them one
+        ranked = player_ids[:args.players if args.scores is None else args.scores]
+        mix = WORKLOADS[args.workload]
+        if args.warmup:
+            drive(make_sender, games, ranked, mix, args.clients, args.warmup)
+        results = drive(make_sender, games, ranked, mix, args.clients, args.duration)
+
+    report = {
+        "commit": current_commit(),
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "server": args.server,
+        "workers": args.workers if args.server == "gunicorn" else None,
+        "threads": args.threads if args.server == "gunicorn" else None,
+        "workload": args.workload,
+        "players": args.players,
+        "scores": args.players if args.scores is None else args.scores,
+        "games": args.games,
+        "clients": args.clients,
+        "duration_s": args.duration,
+        "operations": {name: summarize(latencies, errors, args.duration)
+                       for name, (latencies, errors) in results.items()},
+        "total": summarize([latency for latencies, _ in results.values() for latency in latencies],
+                           sum(errors for _, errors in results.values()), args.duration),
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+
+BENCHMARKS = {
+    "rank": bench_rank,
+    "scorer": bench_scorer,
+    "throughput": bench_throughput,
+    "export": bench_export,
+    "import": bench_import,
+    "json": bench_json,
+}
+
+if __name__ == '__main__':
+    name = sys.argv[1] if len(sys.argv) > 1 else "rank"
+    if name == "load":
+        bench_load(sys.argv[2:])
+        sys.exit()
+    sizes = [int(arg) for arg in sys.argv[2:]] or ([1, 2, 4] if name == "throughput" else [1000, 10000, 100000])
+    BENCHMARKS[name](sizes)
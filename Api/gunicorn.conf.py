@@ -0,0 +1,9 @@
+# gunicorn settings, worker and thread counts can be overridden from the environment
+import multiprocessing
+import os
+
+bind = "0.0.0.0:80"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+# the database is created and migrated once in the master before the workers are forked
+preload_app = True